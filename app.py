@@ -1,19 +1,37 @@
+import hashlib
+import json
 import os
+import shutil
 import tempfile
+import uuid
 from datetime import datetime
 
 import streamlit as st
+from langchain_core.messages import ToolMessage
 
-from llm import build_agent_for_db_path
+from history import ChatHistory
+from llm import build_agent_for_db_path, iter_async, summarize_chat
 
 # Configure page
 st.set_page_config(page_title="SQL Chat Agent", page_icon="💬", layout="wide")
 
+# Uploads are stored by content hash so identical files share one path
+UPLOAD_DIR = os.path.join(tempfile.gettempdir(), "sql_agent_uploads")
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Chat history is capped; once it grows past MAX_HISTORY the oldest
+# SUMMARY_BATCH messages are folded into a single summary message
+MAX_HISTORY = 50
+SUMMARY_BATCH = 20
+
+# Stored execution steps keep only short string previews, never query results
+MAX_STEP_ARGS_CHARS = 2000
+MAX_STEP_CONTENT_CHARS = 4000
+
 # Initialize session state
 def init_session_state():
     """Initialize session state variables."""
     defaults = {
-        "messages": [],
         "db_path": None,
         "agent": None,
         "db": None,
@@ -21,30 +39,71 @@ def init_session_state():
     for key, value in defaults.items():
         if key not in st.session_state:
             st.session_state[key] = value
+    
+    if "history" not in st.session_state:
+        # The session id lives in the URL so reloading the page restores the chat
+        session_id = st.query_params.get("session") or uuid.uuid4().hex
+        st.query_params["session"] = session_id
+        st.session_state.history = ChatHistory(session_id)
+        
+        # Reopen the database the restored chat was about, if it is still on disk
+        db_path = st.session_state.history.get_db_path()
+        if db_path and os.path.exists(db_path):
+            st.session_state.db_path = db_path
 
-@st.cache_resource(show_spinner=False)
 def get_agent(db_path: str):
-    """Get cached agent and database for the given path."""
-    return build_agent_for_db_path(db_path)
+    """Get the session's agent and database for the given path, building on first use."""
+    bundle = st.session_state.setdefault("_agents", {})
+    if db_path not in bundle:
+        bundle[db_path] = build_agent_for_db_path(db_path)
+    return bundle[db_path]
+
+def save_upload(uploaded) -> str:
+    """Write the upload to a path named by its content hash, skipping files already on disk."""
+    hasher = hashlib.blake2b(digest_size=16)
+    uploaded.seek(0)
+    for chunk in iter(lambda: uploaded.read(UPLOAD_CHUNK_SIZE), b""):
+        hasher.update(chunk)
+    path = os.path.join(UPLOAD_DIR, f"{hasher.hexdigest()}.db")
+    
+    if not os.path.exists(path):
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        uploaded.seek(0)
+        with tempfile.NamedTemporaryFile(dir=UPLOAD_DIR, suffix=".db", delete=False) as tmp:
+            shutil.copyfileobj(uploaded, tmp, length=UPLOAD_CHUNK_SIZE)
+        os.replace(tmp.name, path)
+    return path
+
+def select_database(db_path: str) -> bool:
+    """Switch the session to db_path, clearing the chat only if the database changed."""
+    if st.session_state.db_path == db_path:
+        return False
+    history = st.session_state.history
+    previous = history.get_db_path()
+    st.session_state.db_path = db_path
+    st.session_state.agent = None
+    history.set_db_path(db_path)
+    if previous is not None and previous != db_path:
+        history.clear()
+    return True
 
 def setup_database():
     """Handle database upload and initialization."""
     uploaded = st.file_uploader("Upload SQLite .db file", type=["db", "sqlite", "sqlite3"])
     
     if uploaded is not None:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".db") as tmp:
-            tmp.write(uploaded.getbuffer())
-            if st.session_state.db_path != tmp.name:
-                st.session_state.db_path = tmp.name
-                st.session_state.agent = None
-                st.session_state.messages = []
-                st.success("Database uploaded!")
+        # Hash each upload once, not on every rerun
+        upload_paths = st.session_state.setdefault("_upload_paths", {})
+        if uploaded.file_id not in upload_paths:
+            upload_paths[uploaded.file_id] = save_upload(uploaded)
+        if select_database(upload_paths[uploaded.file_id]):
+            st.success("Database uploaded!")
     
     # Use default database if available
     if st.session_state.db_path is None:
         default_path = os.path.join(os.getcwd(), "Chinook.db")
         if os.path.exists(default_path):
-            st.session_state.db_path = default_path
+            select_database(default_path)
             st.info("Using bundled Chinook.db")
     
     # Initialize agent
@@ -62,30 +121,58 @@ def display_database_info():
         st.subheader("📊 Database Info")
         st.write(f"**Dialect:** {st.session_state.db.dialect}")
         with st.expander("Available Tables", expanded=False):
-            tables = sorted(st.session_state.db.get_usable_table_names())
-            for table in tables:
+            for table in st.session_state.db._cached_table_names:
                 st.write(f"• {table}")
 
+def truncate(text, limit):
+    """Cut text to at most limit characters, marking the cut with an ellipsis."""
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
 def parse_step_info(message, step_count):
-    """Parse step information from agent message."""
+    """Parse a compact, string-only step record from an agent message."""
     step_info = {"step": step_count}
     
     if hasattr(message, 'tool_calls') and message.tool_calls:
         tool_call = message.tool_calls[0]
+        args = tool_call.get('args')
         step_info["tool_call"] = {
             "name": tool_call['name'],
-            "args": tool_call.get('args', {})
+            "args": truncate(json.dumps(args, ensure_ascii=False), MAX_STEP_ARGS_CHARS) if args else ""
         }
+    elif isinstance(message, ToolMessage):
+        # Tool output can be a full result set; record only where it came from
+        step_info["tool_result"] = {"name": message.name, "size": len(str(message.content))}
     elif message.content:
-        step_info["content"] = message.content
+        step_info["content"] = truncate(str(message.content), MAX_STEP_CONTENT_CHARS)
     else:
         step_info["type"] = type(message).__name__
     
     return step_info
 
-def display_execution_steps(steps):
-    """Display execution steps in an expandable section."""
-    with st.expander(f"🔍 View execution steps ({len(steps)} steps)", expanded=False):
+def compact_history():
+    """Replace the oldest stored messages with a summary once history exceeds MAX_HISTORY."""
+    history = st.session_state.history
+    if len(history) <= MAX_HISTORY:
+        return
+    
+    try:
+        summary = summarize_chat(history.oldest(SUMMARY_BATCH))
+    except Exception:
+        # Keep the full history and retry after the next turn
+        return
+    history.replace_oldest(SUMMARY_BATCH, {
+        "role": "assistant",
+        "content": f"Summary of earlier conversation: {summary}",
+        "timestamp": datetime.now()
+    })
+
+@st.fragment
+def display_execution_steps(steps, key):
+    """Display execution steps, rendering them only while the toggle is on."""
+    # Running as a fragment, flipping the toggle reruns only this block
+    if not st.toggle(f"🔍 View execution steps ({len(steps)} steps)", key=key):
+        return
+    with st.container(border=True):
         for i, step in enumerate(steps, 1):
             st.markdown(f"**Step {i}:**")
             
@@ -93,7 +180,10 @@ def display_execution_steps(steps):
                 tool_call = step["tool_call"]
                 st.markdown(f"🔧 **Tool:** `{tool_call['name']}`")
                 if tool_call.get('args'):
-                    st.json(tool_call['args'])
+                    st.code(tool_call['args'], language="json")
+            elif step.get("tool_result"):
+                tool_result = step["tool_result"]
+                st.markdown(f"📥 **Result:** `{tool_result['name']}` returned {tool_result['size']} characters")
             elif step.get("content"):
                 st.markdown(f"💬 **Response:** {step['content']}")
             else:
@@ -112,7 +202,7 @@ with st.sidebar:
     display_database_info()
     
     if st.button("🗑️ Clear Chat", use_container_width=True):
-        st.session_state.messages = []
+        st.session_state.history.clear()
         st.rerun()
 
 # Main chat interface
@@ -123,7 +213,7 @@ if not st.session_state.agent:
     st.warning("Please upload a database file or place 'Chinook.db' in the project root to start chatting.")
 else:
     # Display chat history
-    for message in st.session_state.messages:
+    for message in st.session_state.history.recent(MAX_HISTORY):
         if message["role"] == "user":
             with st.chat_message("user"):
                 st.write(message["content"])
@@ -131,12 +221,12 @@ else:
             with st.chat_message("assistant"):
                 st.write(message["content"])
                 if "steps" in message:
-                    display_execution_steps(message["steps"])
+                    display_execution_steps(message["steps"], key=f"steps_{message['id']}")
 
     # Chat input
     if prompt := st.chat_input("Ask a question about your database..."):
         # Add and display user message
-        st.session_state.messages.append({"role": "user", "content": prompt})
+        st.session_state.history.append({"role": "user", "content": prompt})
         with st.chat_message("user"):
             st.write(prompt)
         
@@ -148,29 +238,45 @@ else:
             thinking_placeholder.info("🤔 Thinking...")
             
             try:
-                messages = []
+                final_message = None
                 steps = []
                 step_count = 0
+                buffer = ""
                 
-                # Stream agent execution
-                for step in st.session_state.agent.stream(
+                # Stream agent execution: tokens for the answer, per-node updates for the steps
+                for mode, chunk in iter_async(st.session_state.agent.astream(
                     {"messages": [{"role": "user", "content": prompt}]}, 
-                    stream_mode="values"
-                ):
-                    step_count += 1
-                    last_message = step["messages"][-1]
-                    messages.append(last_message)
-                    steps.append(parse_step_info(last_message, step_count))
-                    thinking_placeholder.info(f"🔄 Step {step_count}: Processing...")
+                    stream_mode=["messages", "updates"]
+                )):
+                    if mode == "messages":
+                        token, metadata = chunk
+                        if metadata.get("langgraph_node") == "generate_query" and token.content:
+                            buffer += token.content
+                            response_placeholder.markdown(buffer + "▌")
+                        continue
+                    
+                    for node_name, delta in chunk.items():
+                        if not delta:
+                            continue
+                        step_count += 1
+                        last_message = delta["messages"][-1]
+                        final_message = last_message
+                        steps.append(parse_step_info(last_message, step_count))
+                        thinking_placeholder.info(f"🔄 Step {step_count}: Processing...")
+                        
+                        # Text streamed alongside a tool call is not the final answer
+                        if buffer and getattr(last_message, "tool_calls", None):
+                            buffer = ""
+                            response_placeholder.empty()
                 
                 thinking_placeholder.empty()
                 
-                if messages and messages[-1].content:
-                    final_answer = messages[-1].content
+                if final_message is not None and final_message.content:
+                    final_answer = final_message.content
                     response_placeholder.success(final_answer)
                     
                     # Add to chat history
-                    st.session_state.messages.append({
+                    st.session_state.history.append({
                         "role": "assistant", 
                         "content": final_answer,
                         "steps": steps,
@@ -182,11 +288,11 @@ else:
             except Exception as e:
                 thinking_placeholder.empty()
                 response_placeholder.error(f"Error: {str(e)}")
-                st.session_state.messages.append({
+                st.session_state.history.append({
                     "role": "assistant", 
                     "content": f"Sorry, I encountered an error: {str(e)}",
                     "steps": [],
                     "timestamp": datetime.now()
                 })
-
-
+        
+        compact_history()
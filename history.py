@@ -0,0 +1,132 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import uuid
+from datetime import datetime
+from typing import List, Optional
+
+HISTORY_DB_PATH = os.getenv("CHAT_HISTORY_PATH", os.path.join(tempfile.gettempdir(), "sql_agent_history.db"))
+
+
+class ChatHistory:
+    """Chat messages and the selected database for one session, stored in SQLite
+    instead of process memory.
+
+    Messages are dicts with ``role`` and ``content`` plus optional extra keys
+    (such as ``steps``), which are serialized to JSON alongside the content.
+    Each stored message is given a unique ``id``.
+    """
+
+    def __init__(self, session_id: str, path: str = HISTORY_DB_PATH):
+        self.session_id = session_id
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS chat_history (
+                session_id TEXT NOT NULL,
+                turn_idx INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content_json TEXT NOT NULL,
+                ts TEXT NOT NULL,
+                PRIMARY KEY (session_id, turn_idx)
+            )"""
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                db_path TEXT
+            )"""
+        )
+        self._conn.commit()
+
+    def get_db_path(self) -> Optional[str]:
+        """Return the database path this session's chat belongs to, if any."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT db_path FROM sessions WHERE session_id = ?", (self.session_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_db_path(self, db_path: str) -> None:
+        """Record the database path this session's chat belongs to."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, db_path) VALUES (?, ?)",
+                (self.session_id, db_path),
+            )
+
+    def _insert(self, turn_idx: int, message: dict) -> None:
+        payload = {k: v for k, v in message.items() if k not in ("role", "timestamp", "turn_idx")}
+        # turn_idx restarts after clear(), so give each message its own stable id
+        payload.setdefault("id", uuid.uuid4().hex)
+        ts = message.get("timestamp") or datetime.now()
+        self._conn.execute(
+            "INSERT INTO chat_history VALUES (?, ?, ?, ?, ?)",
+            (self.session_id, turn_idx, message["role"], json.dumps(payload, default=str), ts.isoformat()),
+        )
+
+    def append(self, message: dict) -> None:
+        """Store one message after the current last turn."""
+        with self._lock, self._conn:
+            (last,) = self._conn.execute(
+                "SELECT COALESCE(MAX(turn_idx), -1) FROM chat_history WHERE session_id = ?",
+                (self.session_id,),
+            ).fetchone()
+            self._insert(last + 1, message)
+
+    def recent(self, limit: int) -> List[dict]:
+        """Return the last ``limit`` messages, oldest first, each with its ``turn_idx``."""
+        with self._lock:
+            rows = self._conn.execute(
+                """SELECT turn_idx, role, content_json, ts FROM chat_history
+                WHERE session_id = ? ORDER BY turn_idx DESC LIMIT ?""",
+                (self.session_id, limit),
+            ).fetchall()
+        messages = []
+        for turn_idx, role, content_json, ts in reversed(rows):
+            message = {"role": role, **json.loads(content_json)}
+            message["timestamp"] = datetime.fromisoformat(ts)
+            message["turn_idx"] = turn_idx
+            messages.append(message)
+        return messages
+
+    def oldest(self, limit: int) -> List[dict]:
+        """Return the first ``limit`` messages, oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                """SELECT role, content_json FROM chat_history
+                WHERE session_id = ? ORDER BY turn_idx LIMIT ?""",
+                (self.session_id, limit),
+            ).fetchall()
+        return [{"role": role, **json.loads(content_json)} for role, content_json in rows]
+
+    def replace_oldest(self, count: int, message: dict) -> None:
+        """Replace the first ``count`` messages with a single message in their place."""
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                "SELECT turn_idx FROM chat_history WHERE session_id = ? ORDER BY turn_idx LIMIT ?",
+                (self.session_id, count),
+            ).fetchall()
+            if not rows:
+                return
+            self._conn.execute(
+                "DELETE FROM chat_history WHERE session_id = ? AND turn_idx <= ?",
+                (self.session_id, rows[-1][0]),
+            )
+            self._insert(rows[0][0], message)
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._conn.execute(
+                "SELECT COUNT(*) FROM chat_history WHERE session_id = ?", (self.session_id,)
+            ).fetchone()
+        return count
+
+    def clear(self) -> None:
+        """Delete every message in this session."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM chat_history WHERE session_id = ?", (self.session_id,))
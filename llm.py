@@ -1,51 +1,50 @@
+import asyncio
+import atexit
+import functools
 import os
-from typing import Literal, Tuple
+import re
+import threading
+from typing import Dict, FrozenSet, List, Literal, Optional, Tuple
 
 import dotenv
+import httpx
 from langchain.chat_models import init_chat_model
 from langchain_community.agent_toolkits import SQLDatabaseToolkit
+from langchain_community.cache import SQLiteCache
 from langchain_community.utilities import SQLDatabase
-from langchain_core.messages import AIMessage
+from langchain_core.globals import set_llm_cache
+from langchain_core.messages import AIMessage, AnyMessage, ToolMessage
+from langchain_core.messages.utils import count_tokens_approximately, trim_messages
+from langchain_core.runnables import RunnableConfig
 from langgraph.graph import END, START, MessagesState, StateGraph
-from langgraph.prebuilt import ToolNode
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
 
 dotenv.load_dotenv()
 
+# One keep-alive HTTP/2 client shared by every Groq call in the process
+HTTP_CLIENT = httpx.Client(http2=True, timeout=60, limits=httpx.Limits(max_keepalive_connections=10))
+atexit.register(HTTP_CLIENT.close)
+# Async counterpart used by the graph nodes. Its pooled connections are bound to
+# the loop that opened them, so every async run goes through EVENT_LOOP, which
+# lives for the whole process (see iter_async)
+HTTP_ASYNC_CLIENT = httpx.AsyncClient(http2=True, timeout=60, limits=httpx.Limits(max_keepalive_connections=10))
+EVENT_LOOP = asyncio.new_event_loop()
+threading.Thread(target=EVENT_LOOP.run_forever, daemon=True).start()
 
-def build_agent_for_db_path(db_path: str, model: str = "groq:meta-llama/llama-4-scout-17b-16e-instruct") -> Tuple[object, SQLDatabase]:
-    """Build a SQL agent for the given database path."""
-    llm = init_chat_model(model, api_key=os.getenv("GROQ_API_KEY"))
-    db = SQLDatabase.from_uri(f"sqlite:///{db_path}")
-    
-    toolkit = SQLDatabaseToolkit(db=db, llm=llm)
-    tools = toolkit.get_tools()
-    
-    # Get required tools
-    get_schema_tool = next(t for t in tools if t.name == "sql_db_schema")
-    run_query_tool = next(t for t in tools if t.name == "sql_db_query")
-    list_tables_tool = next(t for t in tools if t.name == "sql_db_list_tables")
-    
-    # Create tool nodes
-    get_schema_node = ToolNode([get_schema_tool], name="get_schema")
-    run_query_node = ToolNode([run_query_tool], name="run_query")
-    
-    def list_tables(state: MessagesState):
-        """List all available tables in the database."""
-        # Directly invoke the tool without creating tool call messages
-        tables = db.get_usable_table_names()
-        response = AIMessage(f"Available tables: {', '.join(tables)}")
-        return {"messages": [response]}
+# Serve repeated LLM calls (same prompt, same tools) from a local cache
+set_llm_cache(SQLiteCache(database_path=os.getenv("LLM_CACHE_PATH", ".langchain.db")))
 
-    def call_get_schema(state: MessagesState):
-        """Force model to get schema for relevant tables."""
-        llm_with_tools = llm.bind_tools([get_schema_tool], tool_choice="any")
-        response = llm_with_tools.invoke(state["messages"])
-        return {"messages": [response]}
 
-    def generate_query(state: MessagesState):
-        """Generate SQL query based on user question."""
-        system_prompt = f"""You are an agent designed to interact with a SQL database.
-Given an input question, create a syntactically correct {db.dialect} query to run,
+DEFAULT_MODEL = "groq:meta-llama/llama-4-scout-17b-16e-instruct"
+
+# Databases with at most this many tables get every schema fetched up front,
+# skipping the LLM call that picks the relevant tables
+SCHEMA_TABLE_THRESHOLD = 25
+
+
+GENERATE_QUERY_PROMPT = """You are an agent designed to interact with a SQL database.
+Given an input question, create a syntactically correct {dialect} query to run,
 then look at the results of the query and return the answer. Unless the user
 specifies a specific number of examples they wish to obtain, always limit your
 query to at most 5 results.
@@ -55,16 +54,9 @@ examples in the database. Never query for all the columns from a specific table,
 only ask for the relevant columns given the question.
 
 DO NOT make any DML statements (INSERT, UPDATE, DELETE, DROP etc.) to the database."""
-        
-        system_message = {"role": "system", "content": system_prompt}
-        llm_with_tools = llm.bind_tools([run_query_tool])
-        response = llm_with_tools.invoke([system_message] + state["messages"])
-        return {"messages": [response]}
 
-    def check_query(state: MessagesState):
-        """Double-check the generated query for common mistakes."""
-        system_prompt = f"""You are a SQL expert with a strong attention to detail.
-Double check the {db.dialect} query for common mistakes, including:
+CHECK_QUERY_PROMPT = """You are a SQL expert with a strong attention to detail.
+Double check the {dialect} query for common mistakes, including:
 - Using NOT IN with NULL values
 - Using UNION when UNION ALL should have been used
 - Using BETWEEN for exclusive ranges
@@ -78,15 +70,230 @@ If there are any of the above mistakes, rewrite the query. If there are no mista
 just reproduce the original query.
 
 You will call the appropriate tool to execute the query after running this check."""
-        
-        system_message = {"role": "system", "content": system_prompt}
+
+# Queries check_query can pass through without an LLM review: a single SELECT
+# with none of the constructs CHECK_QUERY_PROMPT looks for and no DML/DDL
+SAFE_QUERY_START = re.compile(r"^\s*SELECT\b", re.IGNORECASE)
+UNSAFE_QUERY_PATTERN = re.compile(
+    r"\b(NOT\s+IN|BETWEEN|INSERT|UPDATE|DELETE|DROP|ALTER|CREATE|REPLACE|TRUNCATE|ATTACH|DETACH|PRAGMA)\b"
+    r"|\bUNION\b(?!\s+ALL\b)",
+    re.IGNORECASE,
+)
+
+SUMMARY_PROMPT = """Summarize the following conversation between a user and a SQL
+assistant in a short paragraph. Keep the questions asked, the key figures in the
+answers and any facts about the database that later questions may rely on."""
+
+# Approximate token budget for query/result exchanges before the latest one
+HISTORY_TOKEN_BUDGET = 3000
+# The latest query result is always kept, cut to this many characters
+MAX_TOOL_RESULT_CHARS = 8000
+
+# Connection settings for the agent's read-only analytic queries
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA query_only=1",
+)
+
+
+def _create_sqlite_engine(db_path: str) -> Engine:
+    """Create a SQLite engine that applies SQLITE_PRAGMAS to every new connection."""
+    engine = create_engine(f"sqlite:///{db_path}")
+
+    @event.listens_for(engine, "connect")
+    def _apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return engine
+
+
+class SchemaCachingSQLDatabase(SQLDatabase):
+    """SQLDatabase that memoizes table info, since an uploaded schema does not change."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._table_info_cache: Dict[Tuple[Optional[FrozenSet[str]], bool], str] = {}
+
+    def get_table_info(self, table_names: Optional[List[str]] = None, get_col_comments: bool = False) -> str:
+        key = (frozenset(table_names) if table_names is not None else None, get_col_comments)
+        if key not in self._table_info_cache:
+            self._table_info_cache[key] = super().get_table_info(table_names, get_col_comments=get_col_comments)
+        return self._table_info_cache[key]
+
+
+def _is_trivially_safe(query: str) -> bool:
+    """Return True if the query can skip the LLM check."""
+    if ";" in query.strip().rstrip(";"):
+        return False
+    return bool(SAFE_QUERY_START.match(query)) and not UNSAFE_QUERY_PATTERN.search(query)
+
+
+def _trim_history(messages: List[AnyMessage]) -> List[AnyMessage]:
+    """Keep the question, schema and latest exchange, plus older exchanges that fit the budget."""
+    schema_end = 0
+    for i, message in enumerate(messages):
+        if isinstance(message, ToolMessage) and message.name == "sql_db_schema":
+            schema_end = i + 1
+    tail = messages[schema_end:]
+    
+    # Always keep the latest tool call and its result so the model sees what it just fetched
+    latest_start = len(tail)
+    for i in range(len(tail) - 1, -1, -1):
+        if isinstance(tail[i], AIMessage) and tail[i].tool_calls:
+            latest_start = i
+            break
+    latest = [
+        m.model_copy(update={"content": m.content[:MAX_TOOL_RESULT_CHARS] + "\n... (truncated)"})
+        if isinstance(m, ToolMessage) and isinstance(m.content, str) and len(m.content) > MAX_TOOL_RESULT_CHARS
+        else m
+        for m in tail[latest_start:]
+    ]
+    
+    older = trim_messages(
+        tail[:latest_start],
+        max_tokens=HISTORY_TOKEN_BUDGET,
+        strategy="last",
+        token_counter=count_tokens_approximately,
+        start_on="ai",
+    )
+    return messages[:schema_end] + older + latest
+
+
+async def _run_tool_call(tool, tool_call: dict, config: RunnableConfig) -> ToolMessage:
+    """Run one tool call, returning errors to the model as a ToolMessage like ToolNode does."""
+    try:
+        return await tool.ainvoke(tool_call, config)
+    except Exception as e:
+        return ToolMessage(
+            content=f"Error: {e!r}\n Please fix your mistakes.",
+            name=tool.name,
+            tool_call_id=tool_call["id"],
+            status="error",
+        )
+
+
+def iter_async(agen):
+    """Iterate an async generator on EVENT_LOOP, yielding items to the calling thread."""
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(agen.__anext__(), EVENT_LOOP).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        # Stop the run on the loop if the caller stops iterating mid-stream
+        asyncio.run_coroutine_threadsafe(agen.aclose(), EVENT_LOOP)
+
+
+def _db_context(config: RunnableConfig) -> dict:
+    """Return the per-database objects bound to this run."""
+    return config["configurable"]["sql_agent"]
+
+
+@functools.lru_cache(maxsize=4)
+def _get_llm(model: str):
+    """Create the chat model once per model name so its HTTP client is reused."""
+    kwargs = (
+        {"http_client": HTTP_CLIENT, "http_async_client": HTTP_ASYNC_CLIENT}
+        if model.startswith("groq:")
+        else {}
+    )
+    return init_chat_model(
+        model, api_key=os.getenv("GROQ_API_KEY"), temperature=0, max_tokens=512, **kwargs
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def _build_graph(model: str = DEFAULT_MODEL) -> Tuple[object, object]:
+    """Build the LLM and compiled agent graph once per process.
+
+    The graph topology does not depend on the database; the database and its
+    tools are supplied at run time through ``config["configurable"]``.
+    """
+    llm = _get_llm(model)
+
+    def list_tables(state: MessagesState, config: RunnableConfig):
+        """List all available tables in the database."""
+        # Directly invoke the tool without creating tool call messages
+        tables = _db_context(config)["db"]._cached_table_names
+        response = AIMessage(f"Available tables: {', '.join(tables)}")
+        return {"messages": [response]}
+
+    def route_schema(state: MessagesState, config: RunnableConfig) -> Literal["get_schema_all", "call_get_schema"]:
+        """Fetch all schemas directly for small databases, otherwise let the model choose."""
+        tables = _db_context(config)["db"]._cached_table_names
+        return "get_schema_all" if len(tables) <= SCHEMA_TABLE_THRESHOLD else "call_get_schema"
+
+    async def get_schema_all(state: MessagesState, config: RunnableConfig):
+        """Get the schema of every table without an LLM call."""
+        ctx = _db_context(config)
+        tables = ctx["db"]._cached_table_names
+        tool_call = {
+            "name": ctx["get_schema_tool"].name,
+            "args": {"table_names": ", ".join(tables)},
+            "id": "get_schema_all",
+            "type": "tool_call",
+        }
+        # Introspect tables concurrently; each result is cached per table afterwards
+        schemas = await asyncio.gather(
+            *(asyncio.to_thread(ctx["get_schema_tool"].invoke, {"table_names": table}) for table in tables)
+        )
+        response = AIMessage(content="", tool_calls=[tool_call])
+        result = ToolMessage(
+            content="\n\n".join(schemas), name=tool_call["name"], tool_call_id=tool_call["id"]
+        )
+        return {"messages": [response, result]}
+
+    async def call_get_schema(state: MessagesState, config: RunnableConfig):
+        """Force model to get schema for relevant tables."""
+        get_schema_tool = _db_context(config)["get_schema_tool"]
+        llm_with_tools = llm.bind_tools([get_schema_tool], tool_choice="any")
+        response = await llm_with_tools.ainvoke(state["messages"], config)
+        return {"messages": [response]}
+
+    async def get_schema(state: MessagesState, config: RunnableConfig):
+        """Run the schema tool for each requested tool call."""
+        get_schema_tool = _db_context(config)["get_schema_tool"]
+        tool_calls = state["messages"][-1].tool_calls
+        results = await asyncio.gather(*(_run_tool_call(get_schema_tool, tc, config) for tc in tool_calls))
+        return {"messages": list(results)}
+
+    async def generate_query(state: MessagesState, config: RunnableConfig):
+        """Generate SQL query based on user question."""
+        ctx = _db_context(config)
+        llm_with_tools = llm.bind_tools([ctx["run_query_tool"]])
+        response = await llm_with_tools.ainvoke(
+            [ctx["generate_system_message"]] + _trim_history(state["messages"]), config
+        )
+        return {"messages": [response]}
+
+    async def check_query(state: MessagesState, config: RunnableConfig):
+        """Double-check the generated query for common mistakes."""
+        ctx = _db_context(config)
         tool_call = state["messages"][-1].tool_calls[0]
+        if _is_trivially_safe(tool_call["args"]["query"]):
+            response = AIMessage(content="", tool_calls=[tool_call], id=state["messages"][-1].id)
+            return {"messages": [response]}
+        
         user_message = {"role": "user", "content": tool_call["args"]["query"]}
-        llm_with_tools = llm.bind_tools([run_query_tool], tool_choice="any")
-        response = llm_with_tools.invoke([system_message, user_message])
+        # The check only needs to echo or rewrite one query
+        llm_with_tools = llm.bind_tools([ctx["run_query_tool"]], tool_choice="any", max_tokens=256)
+        response = await llm_with_tools.ainvoke([ctx["check_system_message"], user_message], config)
         response.id = state["messages"][-1].id
         return {"messages": [response]}
 
+    async def run_query(state: MessagesState, config: RunnableConfig):
+        """Execute the checked query."""
+        run_query_tool = _db_context(config)["run_query_tool"]
+        tool_calls = state["messages"][-1].tool_calls
+        return {"messages": [await _run_tool_call(run_query_tool, tc, config) for tc in tool_calls]}
+
     def should_continue(state: MessagesState) -> Literal[END, "check_query"]:
         """Decide whether to continue to query checking or end."""
         last_message = state["messages"][-1]
@@ -98,11 +305,12 @@ You will call the appropriate tool to execute the query after running this check
     # Add nodes
     nodes = [
         ("list_tables", list_tables),
+        ("get_schema_all", get_schema_all),
         ("call_get_schema", call_get_schema),
-        ("get_schema", get_schema_node),
+        ("get_schema", get_schema),
         ("generate_query", generate_query),
         ("check_query", check_query),
-        ("run_query", run_query_node),
+        ("run_query", run_query),
     ]
     for name, func in nodes:
         builder.add_node(name, func)
@@ -110,7 +318,7 @@ You will call the appropriate tool to execute the query after running this check
     # Add edges
     edges = [
         (START, "list_tables"),
-        ("list_tables", "call_get_schema"),
+        ("get_schema_all", "generate_query"),
         ("call_get_schema", "get_schema"),
         ("get_schema", "generate_query"),
         ("check_query", "run_query"),
@@ -119,9 +327,49 @@ You will call the appropriate tool to execute the query after running this check
     for source, target in edges:
         builder.add_edge(source, target)
     
+    builder.add_conditional_edges("list_tables", route_schema)
     builder.add_conditional_edges("generate_query", should_continue)
     
-    return builder.compile(), db
+    return llm, builder.compile()
+
+
+def build_agent_for_db_path(db_path: str, model: str = DEFAULT_MODEL) -> Tuple[object, SQLDatabase]:
+    """Build a SQL agent for the given database path.
+
+    Only the database and its toolkit are created here; the LLM and the
+    compiled graph are shared across databases.
+    """
+    llm, graph = _build_graph(model)
+    db = SchemaCachingSQLDatabase(engine=_create_sqlite_engine(db_path))
+    db._cached_table_names = sorted(db.get_usable_table_names())
+    
+    toolkit = SQLDatabaseToolkit(db=db, llm=llm)
+    tools = toolkit.get_tools()
+    
+    # Get required tools
+    tool_map = {t.name: t for t in tools}
+    get_schema_tool = tool_map["sql_db_schema"]
+    run_query_tool = tool_map["sql_db_query"]
+    
+    # Formatted once per database so every call sends a byte-identical prompt prefix
+    context = {
+        "db": db,
+        "generate_system_message": {"role": "system", "content": GENERATE_QUERY_PROMPT.format(dialect=db.dialect)},
+        "check_system_message": {"role": "system", "content": CHECK_QUERY_PROMPT.format(dialect=db.dialect)},
+        "get_schema_tool": get_schema_tool,
+        "run_query_tool": run_query_tool,
+    }
+    return graph.with_config(configurable={"sql_agent": context}), db
+
+
+def summarize_chat(messages: List[dict], model: str = DEFAULT_MODEL) -> str:
+    """Summarize chat history entries (dicts with role/content) into a short paragraph."""
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    response = _get_llm(model).invoke([
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": transcript},
+    ])
+    return response.content
 
 
 if __name__ == "__main__":
@@ -131,7 +379,7 @@ if __name__ == "__main__":
         db_path = sys.argv[1]
         question = " ".join(sys.argv[2:])
         agent, _ = build_agent_for_db_path(db_path)
-        for step in agent.stream({"messages": [{"role": "user", "content": question}]}, stream_mode="values"):
+        for step in iter_async(agent.astream({"messages": [{"role": "user", "content": question}]}, stream_mode="values")):
             print(step["messages"][-1])
     else:
         print("Usage: python llm.py <db_path> '<question>'")
\ No newline at end of file
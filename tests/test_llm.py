@@ -0,0 +1,69 @@
+import os
+import sqlite3
+
+# Keep the LLM response cache out of the working tree
+os.environ.setdefault("LLM_CACHE_PATH", ":memory:")
+
+import pytest
+from langchain_core.globals import set_llm_cache
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+
+import llm
+
+
+class FakeToolChatModel(GenericFakeChatModel):
+    """Fake chat model that accepts tool bindings and replays canned messages."""
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = tmp_path / "shop.db"
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE customers (id INTEGER PRIMARY KEY, name TEXT)")
+    conn.executemany("INSERT INTO customers (name) VALUES (?)", [("Ana",), ("Bo",)])
+    conn.commit()
+    conn.close()
+    return str(path)
+
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    # Streaming the fake splits on content and drops tool-call-only messages
+    model = FakeToolChatModel(disable_streaming=True, messages=iter([
+        AIMessage(content="", tool_calls=[{
+            "name": "sql_db_query",
+            "args": {"query": "SELECT name FROM customers LIMIT 5"},
+            "id": "call_1",
+        }]),
+        AIMessage(content="The customers are Ana and Bo."),
+    ]))
+    set_llm_cache(None)
+    monkeypatch.setattr(llm, "_get_llm", lambda model_name: model)
+    llm._build_graph.cache_clear()
+    yield model
+    llm._build_graph.cache_clear()
+
+
+def test_agent_answers_question(db_path, fake_llm):
+    agent, db = llm.build_agent_for_db_path(db_path)
+    assert db._cached_table_names == ["customers"]
+
+    updates = []
+    for mode, chunk in llm.iter_async(agent.astream(
+        {"messages": [{"role": "user", "content": "Who are the customers?"}]},
+        stream_mode=["messages", "updates"],
+    )):
+        if mode == "updates":
+            updates.append(chunk)
+
+    nodes = [name for update in updates for name in update]
+    assert nodes == [
+        "list_tables", "get_schema_all", "generate_query", "check_query", "run_query", "generate_query",
+    ]
+    results = updates[4]["run_query"]["messages"]
+    assert "Ana" in results[0].content and "Bo" in results[0].content
+    assert updates[-1]["generate_query"]["messages"][-1].content == "The customers are Ana and Bo."